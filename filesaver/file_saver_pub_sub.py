@@ -4,9 +4,15 @@ The C2 topic is used to trigger the writing of additional files at an interval s
 """
 import os
 import json
-from time import sleep
-from datetime import datetime
-from typing import Any, Dict, Union
+import queue
+import signal
+import sys
+import threading
+from time import sleep, time
+from dataclasses import dataclass, field
+from functools import partial
+from types import FrameType
+from typing import Any, Dict, List, Optional, Tuple, Union
 
 import schedule
 import paho.mqtt.client as mqtt
@@ -14,13 +20,47 @@ import paho.mqtt.client as mqtt
 from base_mqtt_pub_sub import BaseMQTTPubSub
 
 
+@dataclass
+class SaveStream:
+    """A topic whose payloads are saved to its own series of files.
+
+    Attributes:
+        topic (str): topic to subscribe to and read data from.
+        file_path_prefix (str): the save directory joined with the file prefix, to which
+        the write timestamp and file suffix are appended on rotation.
+        buffer_size (int): the number of queued bytes at which they are written out ahead of
+        the flush interval.
+        file_descriptor (int): the open file descriptor being appended to.
+        pending (List[bytes]): payloads and record separators awaiting a flush, only
+        touched by the writer thread.
+        pending_size (int): the number of bytes in pending.
+    """
+
+    topic: str
+    file_path_prefix: str
+    buffer_size: int
+    file_descriptor: int
+    pending: List[bytes] = field(default_factory=list)
+    pending_size: int = 0
+
+
+# a payload for a stream, or a "flush", "rotate" or "stop" event for the writer thread
+WriteEvent = Tuple[Union[SaveStream, str], bytes]
+
+
 class FileSaverPubSub(BaseMQTTPubSub):
-    """This class writes data payloads published over MQTT topics to JSON[s].
+    """This class writes data payloads published over MQTT topics to newline-delimited JSON[s].
 
     Args:
         BaseMQTTPubSub (BaseMQTTPubSub): parent class written in the EdgeTech Core module.
     """
 
+    # each payload is written as one line of newline-delimited JSON
+    _RECORD_SUFFIX = b"\n"
+
+    # the most buffers a single os.writev call accepts
+    _IOV_MAX = os.sysconf("SC_IOV_MAX")
+
     def __init__(
         self: Any,
         sensor_save_topic: str,
@@ -31,6 +71,8 @@ class FileSaverPubSub(BaseMQTTPubSub):
         telemetry_directory_name: str,
         sensor_file_prefix: str,
         telemetry_file_prefix: str,
+        sensor_buffer_size: int = 8192,
+        telemetry_buffer_size: int = 8192,
         debug: bool = False,
         **kwargs: Any
     ) -> None:
@@ -48,145 +90,248 @@ class FileSaverPubSub(BaseMQTTPubSub):
             telemetry_directory_name (str): the name of the telemetry directory.
             sensor_file_prefix (str): the file prefix for the sensor data, based on kind of data.
             telemetry_file_prefix (str): the file prefix for the telemetry data.
+            sensor_buffer_size (int, optional): the number of queued sensor bytes at which they
+            are written out ahead of the flush interval, sized to the typical payload and
+            message rate. Defaults to 8192.
+            telemetry_buffer_size (int, optional): the number of queued telemetry bytes at which
+            they are written out ahead of the flush interval. Defaults to 8192.
             debug (bool, optional): If the debug mode is turned on, log statements print to stdout.
             Defaults to False.
         """
         # pass kwargs to super class to override class variables
         super().__init__(**kwargs)
 
-        # saving topics
-        self.sensor_save_topic = sensor_save_topic
-        self.telemetry_save_topic = telemetry_save_topic
-
         # trigger topic
         self.c2c_topic = c2c_topic
 
         # toggle logging
         self.debug = debug
 
-        # file write directories
-        self.sensor_save_path = os.path.join(data_root, sensor_directory_name)
-        self.telemetry_save_path = os.path.join(data_root, telemetry_directory_name)
-
-        # file prefix by data
-        self.sensor_file_prefix = sensor_file_prefix
-        self.telemetry_file_prefix = telemetry_file_prefix
-
-        # files saved with write timestamps
-        self.sensor_file_timestamp = ""
-        self.telemetry_file_timestamp = ""
-
-        # this module writes JSON[s]
-        self.file_suffix = ".json"
-
-        # composing filenames
-        self.sensor_file_name = (
-            self.sensor_file_prefix + self.sensor_file_timestamp + self.file_suffix
-        )
-        self.telemetry_file_name = (
-            self.telemetry_file_prefix
-            + self.telemetry_file_timestamp
-            + self.file_suffix
-        )
+        # this module writes newline-delimited JSON[s]
+        self.file_suffix = ".ndjson"
 
         # connecting to MQTT server
         self.connect_client()
         sleep(1)
         self.publish_registration("File Saver Registration")
 
-        # creating save directories if they do not exist
-        os.makedirs(self.sensor_save_path, exist_ok=True)
-        os.makedirs(self.telemetry_save_path, exist_ok=True)
-
-        # to initialize full path by combining save path and filename
-        self.sensor_file_path = None
-        self.telemetry_file_path = None
+        # each kind of data is saved to its own directory through a write file that is
+        # held open between messages and only swapped on rotation
+        self.streams: List[SaveStream] = []
+        for save_topic, directory_name, file_prefix, buffer_size in (
+            (
+                sensor_save_topic,
+                sensor_directory_name,
+                sensor_file_prefix,
+                sensor_buffer_size,
+            ),
+            (
+                telemetry_save_topic,
+                telemetry_directory_name,
+                telemetry_file_prefix,
+                telemetry_buffer_size,
+            ),
+        ):
+            # creating save directories if they do not exist
+            save_path = os.path.join(data_root, directory_name)
+            os.makedirs(save_path, exist_ok=True)
+
+            # joined once here rather than on every rotation
+            file_path_prefix = os.path.join(save_path, file_prefix)
+            self.streams.append(
+                SaveStream(
+                    topic=save_topic,
+                    file_path_prefix=file_path_prefix,
+                    buffer_size=buffer_size,
+                    file_descriptor=self._setup_new_write_file(file_path_prefix, None),
+                )
+            )
 
-        # create write files (JSON array initialization)
-        self.sensor_file_path = self._setup_new_write_file(
-            self.sensor_file_prefix,
-            self.sensor_save_path,
-            self.sensor_file_path,
-        )
-        self.telemetry_file_path = self._setup_new_write_file(
-            self.telemetry_file_prefix,
-            self.telemetry_save_path,
-            self.telemetry_file_path,
+        # payloads and file events handed from the network thread to the writer thread
+        self.write_queue: queue.SimpleQueue[WriteEvent] = queue.SimpleQueue()
+        self.writer_thread = threading.Thread(
+            target=self._write_loop, name="file-writer", daemon=True
         )
 
     def _setup_new_write_file(
-        self: Any, file_prefix: str, save_path: str, file_path: Union[str, None]
-    ) -> str:
-        """If a previous file exists, then the JSON array is closed. Then, a new file is opened
-        up for writing and initialized for writing.
+        self: Any,
+        file_path_prefix: str,
+        file_descriptor: Union[int, None],
+    ) -> int:
+        """A new file is opened up for writing. Then, if a previous file is open, it is synced
+        to disk and closed. The returned file descriptor is kept open so that batches are
+        appended with a single write each. If the new file cannot be opened the previous one
+        stays in use, and a failure to close the previous file does not stop the switch.
 
         Args:
-            file_prefix (str): the file prefix based on the kind of data.
-            save_path (str): the absolute path to the directory to save to.
-            file_path (Union[str, None]): the previous file if it exists else None.
+            file_path_prefix (str): the save directory joined with the file prefix based on
+            the kind of data.
+            file_descriptor (Union[int, None]): the previous file descriptor if it exists
+            else None.
 
         Returns:
-            str: returns the new write file path
+            int: returns the new write file descriptor
         """
 
-        # if a previous file path exists, close the JSON array
-        if file_path:
-            with open(file_path, encoding="utf-8", mode="a") as file_pointer:
-                file_pointer.write("\n]")
-
         # create new file path
-        file_timestamp = str(datetime.utcnow().timestamp())
-        file_name = file_prefix + file_timestamp + self.file_suffix
-        file_path = os.path.join(save_path, file_name)
+        file_path = file_path_prefix + str(time()) + self.file_suffix
 
-        # open new JSON array for writing
-        with open(file_path, encoding="utf-8", mode="a") as file_pointer:
-            file_pointer.write("[")
-
-        # return the new file path for writing
-        return file_path
+        # open new file for writing
+        new_file_descriptor = os.open(
+            file_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644
+        )
 
-    def _sensor_save_callback(
-        self: Any, _client: mqtt.Client, _userdata: Dict[Any, Any], msg: Any
-    ) -> None:
-        """Callback for the sensor data that specifies writing the message payload to the
-        sensor file.
+        # if a previous file is open, close it
+        if file_descriptor is not None:
+            try:
+                try:
+                    os.fsync(file_descriptor)
+                finally:
+                    os.close(file_descriptor)
+            except OSError as exception:
+                print(
+                    f"Failed to sync and close {file_path_prefix} file: {exception}",
+                    file=sys.stderr,
+                )
+
+        # return the new file descriptor for writing
+        return new_file_descriptor
+
+    def _write_pending(self: Any, stream: SaveStream) -> None:
+        """Writes the batch of queued records of a stream to its file and empties the batch.
+        The payload buffers are handed to a single scatter-gather write rather than being
+        copied into one contiguous buffer first.
+
+        If the write fails, for example on a full disk, the batch is dropped and reported on
+        stderr so that the stream keeps saving later records.
 
         Args:
-            _client (mqtt.Client): the MQTT client that was instantiated in the constructor.
-            _userdata (Dict[Any,Any]): data passed to the callback through the MQTT paho Client
-            class constructor or set later through user_data_set().
-            msg (Any): the received message over the subscribed channel that includes
-            the topic name and payload after decoding. The messages here will include the
-            sensor data to save.
+            stream (SaveStream): the stream whose queued records to write.
         """
-        # decode the JSON payload from callback message
-        payload_json_str = str(msg.payload.decode("utf-8"))
+        buffers = stream.pending
+        try:
+            while buffers:
+                written = os.writev(stream.file_descriptor, buffers[: self._IOV_MAX])
+                # drop the buffers that were written, regular files only return short on
+                # errors such as a full disk
+                index = 0
+                while index < len(buffers) and written >= len(buffers[index]):
+                    written -= len(buffers[index])
+                    index += 1
+                if written:
+                    buffers[index] = buffers[index][written:]
+                del buffers[:index]
+        except OSError as exception:
+            print(
+                f"Dropped {sum(len(buffer) for buffer in buffers)} bytes for "
+                f"{stream.file_path_prefix}: {exception}",
+                file=sys.stderr,
+            )
+            buffers.clear()
+        stream.pending_size = 0
 
-        # open and write to sensor file
-        with open(self.sensor_file_path, encoding="utf-8", mode="a") as file_pointer:
-            file_pointer.write("\n\t" + payload_json_str + ",")
+    def _flush_pending(self: Any) -> None:
+        """Writes the records queued by the save callbacks to their files, so that each flush
+        interval costs one os.writev per file, or one per _IOV_MAX buffers for larger batches,
+        regardless of the message rate.
+        """
+        for stream in self.streams:
+            if stream.pending:
+                self._write_pending(stream)
+
+    def _write_loop(self: Any) -> None:
+        """Drains the write queue on a dedicated thread so that the MQTT network thread never
+        blocks on disk. Payloads are queued in the pending batch of their stream, which is
+        written out once it reaches the stream buffer size or on a flush, rotate or stop
+        event. Rotation happens between batches, so records are never split across files
+        out of order. Write and rotation failures are handled per event so that they never
+        stop the thread.
+        """
+        while True:
+            target, payload = self.write_queue.get()
+            if isinstance(target, SaveStream):
+                target.pending.append(payload)
+                target.pending.append(self._RECORD_SUFFIX)
+                target.pending_size += len(payload) + len(self._RECORD_SUFFIX)
+                if target.pending_size >= target.buffer_size:
+                    self._write_pending(target)
+            else:
+                # flush, rotate and stop events write out everything queued so far
+                self._flush_pending()
+                if target == "rotate":
+                    for stream in self.streams:
+                        try:
+                            stream.file_descriptor = self._setup_new_write_file(
+                                stream.file_path_prefix, stream.file_descriptor
+                            )
+                        except OSError as exception:
+                            # keep appending to the current file
+                            print(
+                                f"Failed to rotate {stream.file_path_prefix} file: "
+                                f"{exception}",
+                                file=sys.stderr,
+                            )
+                elif target == "stop":
+                    return
+
+    def _close_write_files(self: Any) -> None:
+        """Stops the writer thread once the records queued so far are written, then syncs the
+        write files to disk and closes them.
+        """
+        if not self.writer_thread.is_alive():
+            print(
+                f"File writer thread is not running, {self.write_queue.qsize()} queued "
+                "payloads were not written",
+                file=sys.stderr,
+            )
+        self.write_queue.put(("stop", b""))
+        self.writer_thread.join()
 
-    def _telemetry_save_callback(
-        self: Any, _client: mqtt.Client, _userdata: Dict[Any, Any], msg: Any
+        for stream in self.streams:
+            try:
+                try:
+                    os.fsync(stream.file_descriptor)
+                finally:
+                    os.close(stream.file_descriptor)
+            except OSError as exception:
+                print(
+                    f"Failed to sync and close {stream.file_path_prefix} file: "
+                    f"{exception}",
+                    file=sys.stderr,
+                )
+
+    def _sigterm_handler(self: Any, _signum: int, _frame: Optional[FrameType]) -> None:
+        """Turns the SIGTERM sent by docker stop into a KeyboardInterrupt, so that the main
+        loop writes out the queued records and closes the files before the process exits.
+
+        Args:
+            _signum (int): the number of the received signal.
+            _frame (Optional[FrameType]): the stack frame interrupted by the signal.
+        """
+        raise KeyboardInterrupt
+
+    def _save_callback(
+        self: Any,
+        stream: SaveStream,
+        _client: mqtt.Client,
+        _userdata: Dict[Any, Any],
+        msg: Any,
     ) -> None:
-        """Callback for the telemetry data that specifies writing the message payload to the
-        telemetry file.
+        """Callback for the data topics that specifies writing the message payload to the file
+        of the stream. The stream is bound when subscribing, so messages on wildcard topics
+        are saved to the stream that subscribed to them.
 
         Args:
+            stream (SaveStream): the stream subscribed to the message topic.
             _client (mqtt.Client): the MQTT client that was instantiated in the constructor.
             _userdata (Dict[Any,Any]): data passed to the callback through the MQTT paho Client
             class constructor or set later through user_data_set().
             msg (Any): the received message over the subscribed channel that includes
             the topic name and payload after decoding. The messages here will include the
-            telemetry data to save.
+            data to save.
         """
-        # decode the JSON payload from callback message
-        payload_json_str = str(msg.payload.decode("utf-8"))
-
-        # open and write to telemetry file
-        with open(self.telemetry_file_path, encoding="utf-8", mode="a") as file_pointer:
-            file_pointer.write("\n\t" + payload_json_str + ",")
+        # hand the JSON payload bytes to the writer thread
+        self.write_queue.put((stream, msg.payload))
 
     def _c2c_callback(
         self: Any, _client: mqtt.Client, _userdata: Dict[Any, Any], msg: Any
@@ -201,21 +346,13 @@ class FileSaverPubSub(BaseMQTTPubSub):
             the topic name and payload after decoding. The messages here will include the C2
             triggers to switch files.
         """
-        # decode the JSON payload from callback message
-        c2c_payload = json.loads(str(msg.payload.decode("utf-8")))
+        # parse the JSON payload bytes from callback message
+        c2c_payload = json.loads(msg.payload)
 
-        # if the payload is NEW FILE then setup new files to write to
+        # if the payload is NEW FILE then have the writer thread switch files once the
+        # records queued so far are written
         if c2c_payload["msg"] == "NEW FILE":
-            self.sensor_file_path = self._setup_new_write_file(
-                self.sensor_file_prefix,
-                self.sensor_save_path,
-                self.sensor_file_path,
-            )
-            self.telemetry_file_path = self._setup_new_write_file(
-                self.telemetry_file_prefix,
-                self.telemetry_save_path,
-                self.telemetry_file_path,
-            )
+            self.write_queue.put(("rotate", b""))
 
     def main(self: Any) -> None:
         """Main loop and function that setup the heartbeat to keep the TCP/IP
@@ -227,44 +364,42 @@ class FileSaverPubSub(BaseMQTTPubSub):
             self.publish_heartbeat, payload="File Saver Heartbeat"
         )
 
+        # write queued records to disk off the MQTT network thread
+        self.writer_thread.start()
+
+        # batch queued records to disk
+        schedule.every(1).seconds.do(self.write_queue.put, ("flush", b""))
+
         # subscribe to relevant topics
         self.add_subscribe_topics(
-            [
-                self.sensor_save_topic,
-                self.telemetry_save_topic,
-                self.c2c_topic,
-            ],
-            [
-                self._sensor_save_callback,
-                self._telemetry_save_callback,
-                self._c2c_callback,
-            ],
-            [2, 2, 2],
+            [stream.topic for stream in self.streams] + [self.c2c_topic],
+            [partial(self._save_callback, stream) for stream in self.streams]
+            + [self._c2c_callback],
+            [2] * (len(self.streams) + 1),
         )
 
+        # docker stop sends SIGTERM, shut down the same way as on an interrupt
+        signal.signal(signal.SIGTERM, self._sigterm_handler)
+
         # keep main thread alive
-        while True:
-            try:
+        try:
+            while True:
                 # flush pending scheduled tasks
                 schedule.run_pending()
-                # keep from running at CPU time
-                sleep(0.001)
-            except KeyboardInterrupt as exception:
-                if self.debug:
-                    print(exception)
-
-                # close JSON arrays on interrupt
-                if self.sensor_file_path:
-                    with open(
-                        self.sensor_file_path, encoding="utf-8", mode="a"
-                    ) as file_pointer:
-                        file_pointer.write("\n]")
-
-                if self.telemetry_file_path:
-                    with open(
-                        self.telemetry_file_path, encoding="utf-8", mode="a"
-                    ) as file_pointer:
-                        file_pointer.write("\n]")
+                # sleep until the next scheduled task is due, callbacks run on the
+                # MQTT network thread and do not depend on this loop
+                next_run = schedule.idle_seconds()
+                if next_run is None:
+                    # no scheduled tasks
+                    sleep(1.0)
+                else:
+                    sleep(min(10.0, max(0.0, next_run)))
+        except KeyboardInterrupt as exception:
+            if self.debug:
+                print(exception)
+
+            # close files on interrupt
+            self._close_write_files()
 
 
 # interactive session
@@ -279,6 +414,8 @@ if __name__ == "__main__":
         telemetry_directory_name=str(os.environ.get("TELEMETRY_DIR")),
         sensor_file_prefix=str(os.environ.get("SENSOR_FILE_PREFIX")),
         telemetry_file_prefix=str(os.environ.get("TELEMETRY_FILE_PREFIX")),
+        sensor_buffer_size=int(os.environ.get("SENSOR_BUFFER_SIZE", 8192)),
+        telemetry_buffer_size=int(os.environ.get("TELEMETRY_BUFFER_SIZE", 8192)),
         mqtt_ip=str(os.environ.get("MQTT_IP")),
     )
     # spin